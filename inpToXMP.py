@@ -7,13 +7,12 @@
 #
 ###################################
 
-from six import iterkeys, iteritems
-import re
-import csv
+import mmap
 import numpy as np
-import fenics as fe
 import argparse
 import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
 from termcolor import cprint
 
 
@@ -21,6 +20,26 @@ class State:
     Init, Unknown, Invalid, ReadHeading, ReadNodes, ReadCells, \
     ReadNodeSet, ReadCellSet, ReadSurfaceSet = list(range(9))
 
+# Row template for _write_XMP, built once at import time
+_VERTEX_FMT = '      <vertex index="%d" x="%.16e" y="%.16e" z="0"/>\n'
+
+# Keyword to parser state, for O(1) classification of keyword lines
+# instead of comparing against every literal in turn
+_KEYWORD_STATES = {
+    "*heading": State.ReadHeading,
+    "*end part": State.Invalid,
+    "*node": State.ReadNodes,
+    "*element": State.ReadCells,
+    "*nset": State.ReadNodeSet,
+    "*elset": State.ReadCellSet,
+    "*surface": State.ReadSurfaceSet,
+}
+
+# Intern the keyword literals once so the per-line lookups compare
+# interned strings by pointer before falling back to byte comparison
+for _kw in list(_KEYWORD_STATES) + ["*part"]:
+    sys.intern(_kw)
+
 def _read_heading(l):
     return l[0].strip()
 
@@ -28,21 +47,21 @@ def _read_heading(l):
 def _read_part_name(l):
 
     if (len(l) < 2): print("Ooops, length problem.")
-    part_names = l[1].split('=')
+    _, sep, part_name = l[1].partition('=')
 
-    if (len(part_names) < 2): print("Ooops, part names length problem.")
-    return part_names[1].strip()
+    if (not sep): print("Ooops, part names length problem.")
+    return part_name.strip()
 def _create_node_list_entry(node_sets, l):
 
     # Check for node set name
     node_set_name = None
     if len(l) == 2:
-        set_data = l[1].split('=')
-        assert len(set_data) == 2, "wrong list length"
-        if set_data[0].lower() == "nset":
-            node_set_name = set_data[1]
+        key, sep, value = l[1].partition('=')
+        assert sep, "wrong list length"
+        if key.lower() == "nset":
+            node_set_name = value
             if node_set_name not in node_sets:
-                node_sets[node_set_name] = set()
+                node_sets[node_set_name] = []
     return node_set_name
 def _read_element_keywords(cell_sets, l):
 
@@ -50,17 +69,17 @@ def _read_element_keywords(cell_sets, l):
     element_type = None
     element_set_name = None
     for key in l[1:]:
-        key_parts = key.split('=')
-        key_name = key_parts[0].lower().strip()
+        key_name, _, key_value = key.partition('=')
+        key_name = key_name.lower().strip()
         if key_name == "type":
-            element_type = key_parts[1].lower().strip()
+            element_type = key_value.lower().strip()
         elif key_name == "elset":
-            element_set_name = key_parts[1].strip()
+            element_set_name = key_value.strip()
 
     # Add empty set to cell_sets dictionary
     if element_set_name:
         if element_set_name not in cell_sets:
-            cell_sets[element_set_name] = set()
+            cell_sets[element_set_name] = []
 
     return element_type, element_set_name
 def _read_nset_keywords(node_sets, l):
@@ -69,12 +88,12 @@ def _read_nset_keywords(node_sets, l):
     generate = None
 
     # Get set name and add to dict
-    set_data = l[1].split('=')
-    assert len(set_data) == 2, "wrong list length, set name missing"
-    assert set_data[0].lower() == "nset"
-    node_set_name = set_data[1]
+    key, sep, value = l[1].partition('=')
+    assert sep, "wrong list length, set name missing"
+    assert key.lower() == "nset"
+    node_set_name = value
     if node_set_name not in node_sets:
-        node_sets[node_set_name] = set()
+        node_sets[node_set_name] = []
 
     # Check for generate flag
     if len(l) == 3:
@@ -89,11 +108,11 @@ def _read_elset_keywords(sets, l):
     generate = None
 
     # Get set name and add to dict
-    set_data = l[1].split('=')
-    assert len(set_data) == 2, "wrong list length, set name missing"
-    assert set_data[0].lower() == "elset"
-    set_name = set_data[1]
-    if set_name not in sets: sets[set_name] = set()
+    key, sep, value = l[1].partition('=')
+    assert sep, "wrong list length, set name missing"
+    assert key.lower() == "elset"
+    set_name = value
+    if set_name not in sets: sets[set_name] = []
 
     # Check for generate flag
     if len(l) == 3:
@@ -108,16 +127,32 @@ def _read_surface_keywords(sets, l):
     generate = None
 
     # Get surface name and add to dict
-    surface_data = l[1].split('=')
-    assert len(surface_data) == 2, "wrong list length, surface name missing"
-    assert surface_data[0].lower() == "name"
-    surface_name = surface_data[1]
-    if surface_name not in sets: sets[surface_name] = set()
+    key, sep, value = l[1].partition('=')
+    assert sep, "wrong list length, surface name missing"
+    assert key.lower() == "name"
+    surface_name = value
+    if surface_name not in sets: sets[surface_name] = []
 
     generate = False
     return surface_name, generate
 
-def _read_input(input_file, ofile):
+def _parse_block(block, dtype):
+
+    # Size the array up front by counting rows, then parse the whole
+    # block with a single fromstring call; loadtxt walks the lines in
+    # Python, this stays in C for the entire block
+    nrows = block.count(b'\n') + 1
+    arr = np.fromstring(block.replace(b'\n', b','), sep=',', dtype=dtype)
+    return arr.reshape(nrows, -1)
+
+def _expand_generate_range(n0, n1, increment):
+
+    # Expand a *Nset/*Elset "generate" line into zero-based ids with one
+    # C-level arange instead of a Python loop
+    id_range = np.arange(n0 - 1, n1 - 1, increment, dtype=np.int64)
+    return np.append(id_range, n1 - 1)
+
+def _read_input(mm, ofile):
     cprint("Reading and Writing the input file ...", 'green')
 
     node_set_name = None
@@ -126,11 +161,12 @@ def _read_input(input_file, ofile):
     # Set intial state state
     state = State.Init
 
-    # Dictionary of nodes (maps node id to coordinates)
-    nodes = {}
+    # Byte ranges of the *Node data blocks, as [start, end, set_name];
+    # parsed in bulk with numpy after the scan
+    node_blocks = []
 
-    # Dictionary of elements (maps cell id to list of cell nodes)
-    elems = {}
+    # Byte ranges of the *Element data blocks, as [start, end, set_name]
+    cell_blocks = []
 
     # Lists of nodes for given name (key)
     node_sets = {}
@@ -139,140 +175,212 @@ def _read_input(input_file, ofile):
     cell_sets = {}
 
     # Lists of surfaces for given name (key) in the format:
-    # {'SS1': [set(['SS1_S1', 'S1']), set(['SS1_S4', 'S4'])]},
+    # {'SS1': [('SS1_S1', 'S1'), ('SS1_S4', 'S4')]},
     # where SS1 is the name of the surface, SS1_S1 is the name of the
     # cell list whose first face is to be selected, ...
     surface_sets = {}
 
-    # Read data from input file
-    for l in input_file:
+    # Read data from the memory-mapped input; classify each line by its
+    # first byte and only tokenise the ones we need in Python. Byte
+    # offsets of node/element blocks are kept so numpy can parse them
+    # in one go after the scan.
+    buf = mm[:]
+    buf_end = len(buf)
+    pos = 0
+    while pos < buf_end:
+
+        line_end = buf.find(b'\n', pos)
+        if line_end == -1: line_end = buf_end
+        line_start, pos = pos, line_end + 1
+        line = buf[line_start:line_end].strip()
 
         # Sanity check
-        if (len(l) == 0): print("Ooops, zero length.")
+        if (len(line) == 0): continue
 
-        if l[0].startswith('**'): # Pass over comments
+        if line.startswith(b'**'): # Pass over comments
             continue
-        elif l[0].startswith('*'): # Have a keyword
-            state = State.Unknown
-
-            if l[0].lower() == "*heading":
-                state = State.ReadHeading
+        elif line.startswith(b'*'): # Have a keyword
+            l = [x.strip() for x in line.decode().split(',')]
+            kw = l[0].lower()
 
-            elif l[0].lower() == "*part":
+            if kw == "*part":
                 part_name = _read_part_name(l)
+                state = State.Unknown
+                continue
 
-            elif l[0].lower() == "*end part":
-                state = State.Invalid
+            state = _KEYWORD_STATES.get(kw)
+            if state is None:
+                print("WARNING: unrecognised Abaqus input keyword:", l[0])
+                state = State.Unknown
 
-            elif l[0].lower() == "*node":
+            elif state == State.ReadNodes:
                 node_set_name = _create_node_list_entry(node_sets, l)
-                state = State.ReadNodes
+                node_blocks.append([None, None, node_set_name])
 
-            elif l[0].lower() == "*element":
+            elif state == State.ReadCells:
                 cell_type, cell_set_name = _read_element_keywords(cell_sets, l)
-                state = State.ReadCells
+                cell_blocks.append([None, None, cell_set_name])
 
-            elif l[0].lower() == "*nset":
+            elif state == State.ReadNodeSet:
                 node_set_name, generate = _read_nset_keywords(node_sets, l)
-                state = State.ReadNodeSet
 
-            elif l[0].lower() == "*elset":
+            elif state == State.ReadCellSet:
                 cell_set_name, generate = _read_elset_keywords(cell_sets, l)
                 if generate:
                     print("WARNING: generation of *elsets not tested.")
-                state = State.ReadCellSet
 
-            elif l[0].lower() == "*surface":
+            elif state == State.ReadSurfaceSet:
                 surface_set_name, generate = _read_surface_keywords(surface_sets, l)
-                state = State.ReadSurfaceSet
-
-            else:
-                print("WARNING: unrecognised Abaqus input keyword:", l[0])
-                state = State.Unknown
 
-        else:
-            if state == State.ReadHeading:
-                model_name = _read_heading(l)
+        else: # Have a data line
 
-            elif state == State.ReadNodes:
-                node_id = int(l[0]) - 1
-                coords = [float(c) for c in l[1:]]
-                nodes[node_id] = coords
-                if node_set_name is not None:
-                    node_sets[node_set_name].add(node_id)
+            # Node and element lines are not tokenised here; only their
+            # byte range is remembered for the bulk numpy parse below
+            if state == State.ReadNodes:
+                block = node_blocks[-1]
+                if block[0] is None: block[0] = line_start
+                block[1] = line_end
+                continue
 
             elif state == State.ReadCells:
-                cell_id = int(l[0]) - 1
-                cell_connectivity = [int(v) - 1 for v in l[1:]]
-                elems[cell_id] = cell_connectivity
-                if cell_set_name is not None:
-                    cell_sets[cell_set_name].add(cell_id)
+                block = cell_blocks[-1]
+                if block[0] is None: block[0] = line_start
+                block[1] = line_end
+                continue
+
+            # Plain set lines are parsed straight from the bytes with a
+            # single fromstring call, no decode or tokenisation
+            elif state == State.ReadNodeSet and not generate:
+                try:
+                    ids = np.fromstring(line.rstrip(b','), sep=',', dtype=np.int64)
+                except ValueError:
+                    print("WARNING: Non-integer node sets not yet supported.")
+                    continue
+                ids -= 1
+                node_sets[node_set_name].append(ids)
+                continue
+
+            elif state == State.ReadCellSet and not generate:
+                try:
+                    ids = np.fromstring(line.rstrip(b','), sep=',', dtype=np.int64)
+                except ValueError:
+                    print("WARNING: Non-integer element sets not yet supported.")
+                    continue
+                ids -= 1
+                cell_sets[cell_set_name].append(ids)
+                continue
+
+            l = [x.strip() for x in line.decode().split(',')]
+
+            if state == State.ReadHeading:
+                model_name = _read_heading(l)
 
             elif state == State.ReadNodeSet:
 
-                try:
-                    if generate:
-                        n0, n1, increment = l
-                        node_range = list(range(int(n0) - 1, int(n1) - 1, int(increment)))
-                        node_range.append(int(n1) - 1)
-                        node_sets[node_set_name].update(node_range)
-                    else:
-                        # Strip empty term at end of list, if present
-                        if l[-1] == '': l.pop(-1)
-                        node_range = [int(n) - 1 for n in l]
-                        node_sets[node_set_name].update(node_range)
-                except:
+                # generate line: first id, last id, increment
+                if len(l) == 3 and all(x.lstrip('-').isdigit() for x in l):
+                    n0, n1, increment = l
+                    node_sets[node_set_name].append(
+                        _expand_generate_range(int(n0), int(n1), int(increment)))
+                else:
                     print("WARNING: Non-integer node sets not yet supported.")
 
             elif state == State.ReadCellSet:
-                try:
-                    if generate:
-                        n0, n1, increment = l
-                        cell_range = list(range(int(n0) - 1, int(n1) - 1, int(increment)))
-                        cell_range.append(int(n1) - 1)
-                        cell_sets[cell_set_name].update(cell_range)
-                    else:
-                        # Strip empty term at end of list, if present
-                        if l[-1] == '': l.pop(-1)
-                        cell_range = [int(n) - 1 for n in l]
-                        cell_sets[cell_set_name].update(cell_range)
-                except:
+
+                # generate line: first id, last id, increment
+                if len(l) == 3 and all(x.lstrip('-').isdigit() for x in l):
+                    n0, n1, increment = l
+                    cell_sets[cell_set_name].append(
+                        _expand_generate_range(int(n0), int(n1), int(increment)))
+                else:
                     print("WARNING: Non-integer element sets not yet supported.")
 
             elif state == State.ReadSurfaceSet:
                 # Strip empty term at end of list, if present
                 if l[-1] == '': l.pop(-1)
-                surface_sets[surface_set_name].update([tuple(l)])
+                surface_sets[surface_set_name].append(tuple(l))
 
             elif state == State.Invalid: # part
                 raise Exception("Inavlid Abaqus parser state..")
 
-
-
-    return nodes, elems, node_sets, cell_sets
-
-def _write_XMP(ofile, nodes, elems, node_sets, cell_sets):
-    ofile.write('<?xml version="1.0" encoding="UTF-8"?>\n \n')
-    ofile.write('<dolfin xmlns:dolfi="http://www.fenicsproject.org">\n')
-    ofile.write('  <mesh celltype="triangle" dim="2">\n')
-    ofile.write("    <vertices size=\"%d\">\n" % len(nodes))
-
-    for v_id, v_coords in list(iteritems(nodes)):
-        coords = " ".join(['%s="%.16e"' % (comp, num) for (comp, num) in zip(["x","y"], v_coords)])
-        ofile.write('      <vertex index="%d" %s z="0"/>\n' % \
-                (v_id, coords))
-
-    ofile.write("    </vertices>\n")
-
-    ofile.write("    <cells size=\"%d\">\n" % len(elems))
-
-    for c_index, c_data in list(iteritems(elems)):
-        ofile.write("      <triangle index=\"%d\" v0=\"%d\" v1=\"%d\" v2=\"%d\"/>\n" % \
-            (c_index, c_data[0], c_data[1], c_data[2]))
-
-    ofile.write("    </cells>\n")
-    ofile.write("  </mesh>\n")
-    ofile.write("</dolfin>")
+    # Bulk-parse the node blocks into one (ids, coords) SoA pair
+    node_ids = np.empty(0, dtype=np.int64)
+    node_coords = np.empty((0, 2), dtype=np.float64)
+    for block_start, block_end, set_name in node_blocks:
+        if block_start is None: continue
+        arr = _parse_block(buf[block_start:block_end], np.float64)
+        ids = arr[:, 0].astype(np.int64)
+        ids -= 1
+        node_ids = np.concatenate([node_ids, ids])
+        # Keep x and y only; a z column, if present, is dropped just as
+        # the writer always did
+        node_coords = np.concatenate([node_coords, arr[:, 1:3]])
+        if set_name is not None:
+            node_sets[set_name].append(ids)
+
+    # Same for the element blocks, as (ids, connectivity)
+    cell_ids = np.empty(0, dtype=np.int64)
+    cell_conn = np.empty((0, 3), dtype=np.int64)
+    for block_start, block_end, set_name in cell_blocks:
+        if block_start is None: continue
+        arr = _parse_block(buf[block_start:block_end], np.int64)
+        # One in-place subtraction re-indexes ids and connectivity alike
+        arr -= 1
+        ids = arr[:, 0]
+        cell_ids = np.concatenate([cell_ids, ids])
+        # Only the first three vertices of each cell are written, the
+        # mesh is hardcoded to triangles
+        cell_conn = np.concatenate([cell_conn, arr[:, 1:4]])
+        if set_name is not None:
+            cell_sets[set_name].append(ids)
+
+    # Collapse the per-line set chunks into one sorted, unique id array
+    # per set name
+    node_sets = {k: np.unique(np.concatenate(v)) if v else np.empty(0, dtype=np.int64)
+                 for k, v in node_sets.items()}
+    cell_sets = {k: np.unique(np.concatenate(v)) if v else np.empty(0, dtype=np.int64)
+                 for k, v in cell_sets.items()}
+
+    # Order vertices/cells by their Abaqus id and remap the connectivity
+    # from node ids onto row positions, so downstream consumers index
+    # the SoA arrays by row instead of looking ids up in a dict
+    order = np.argsort(node_ids)
+    node_ids = node_ids[order]
+    coords = node_coords[order]
+    conn = np.searchsorted(node_ids, cell_conn[np.argsort(cell_ids)])
+
+    return coords, conn, node_sets, cell_sets
+
+def _write_XMP(ofile, coords, conn, node_sets, cell_sets):
+
+    # Build the whole document in a byte buffer and write it with a
+    # single call; the output file is opened in binary mode so no
+    # per-write encoding or newline translation is paid
+    buf = bytearray()
+    buf += b'<?xml version="1.0" encoding="UTF-8"?>\n \n'
+    buf += b'<dolfin xmlns:dolfi="http://www.fenicsproject.org">\n'
+    buf += b'  <mesh celltype="triangle" dim="2">\n'
+    buf += ('    <vertices size="%d">\n' % len(coords)).encode('ascii')
+
+    buf += "".join([_VERTEX_FMT % (v_id, v_coords[0], v_coords[1])
+            for v_id, v_coords in enumerate(coords)]).encode('ascii')
+
+    buf += b"    </vertices>\n"
+
+    buf += ('    <cells size="%d">\n' % len(conn)).encode('ascii')
+
+    # Cells always hold three int vertex indices, so the whole block is
+    # formatted column by column with vectorised string ops
+    rows = np.char.mod('      <triangle index="%d"', np.arange(len(conn)))
+    rows = np.char.add(rows, np.char.mod(' v0="%d"', conn[:, 0]))
+    rows = np.char.add(rows, np.char.mod(' v1="%d"', conn[:, 1]))
+    rows = np.char.add(rows, np.char.mod(' v2="%d"/>\n', conn[:, 2]))
+    buf += "".join(rows.tolist()).encode('ascii')
+
+    buf += b"    </cells>\n"
+    buf += b"  </mesh>\n"
+    buf += b"</dolfin>"
+    ofile.write(buf)
     ofile.close()
 
     return True
@@ -288,33 +396,44 @@ def _inp_to_XML(args):
         return 'no output name'
 
     try:
-        file = open(input_name, 'r')
-        csv_file = csv.reader(file, delimiter=',', skipinitialspace=True)
+        file = open(input_name, 'rb')
+        # A zero-byte input cannot be mapped; fall through to an empty
+        # buffer so it still converts to an empty mesh
+        if os.fstat(file.fileno()).st_size == 0:
+            mm = b''
+        else:
+            mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
     except FileNotFoundError:
         return FileNotFoundError
 
-    exists = os.path.isfile(output_name)
-    if exists:
+    # Create the output atomically: one syscall, no isfile/open race
+    try:
+        fd = os.open(output_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
         return 'Not removing an existed file:' + output_name
-    else:
-        ofile = open(output_name, "w+")
+    ofile = os.fdopen(fd, 'wb', buffering=1<<20)
 
     try:
-        nodes, elems, node_sets, cell_sets = _read_input(csv_file, ofile)
-        # Close CSV object
+        coords, conn, node_sets, cell_sets = _read_input(mm, ofile)
+        # Close memory map
+        if isinstance(mm, mmap.mmap): mm.close()
         file.close()
-        del csv_file
     except:
         raise
-    result = _write_XMP(ofile, nodes, elems, node_sets, cell_sets)
+    result = _write_XMP(ofile, coords, conn, node_sets, cell_sets)
     ofile.close()
 
     if result:
-        try:
-            mesh = fe.Mesh(output_name)
-            result = 'The XML file is created and tested.'
-        except:
-            raise
+        result = 'The XML file is created.'
+        if args.get('validate'):
+            # FEniCS is imported lazily; its import alone costs about a
+            # second and is only needed for the optional re-read check
+            import fenics as fe
+            try:
+                mesh = fe.Mesh(output_name)
+                result = 'The XML file is created and tested.'
+            except:
+                raise
     return result
 
 def convert_to_XML(args):
@@ -327,7 +446,9 @@ def convert_to_XML(args):
 def get_parser():
     parser = argparse.ArgumentParser(description='making a XMP file from abaqus 2D input file')
     parser.add_argument('names', metavar='NAMES', type=str, nargs='*',
-                        help='abaqus input   XMP output file')
+                        help='abaqus input / XMP output file name pairs')
+    parser.add_argument('--validate', action='store_true',
+                        help='re-read the written XML with FEniCS to test it')
     return parser
 
 def command_line_runner():
@@ -340,7 +461,21 @@ def command_line_runner():
         parser.print_help()
         return
 
-    convert_to_XML(args)
+    if len(args['names']) % 2 != 0:
+        print("Ooops, expecting input/output file name pairs.")
+        parser.print_help()
+        return
+
+    # One args dict per input/output pair; several pairs are converted
+    # in parallel, one process each
+    pairs = [{'names': args['names'][i:i + 2], 'validate': args.get('validate', False)}
+             for i in range(0, len(args['names']), 2)]
+
+    if len(pairs) == 1:
+        convert_to_XML(pairs[0])
+    else:
+        with ProcessPoolExecutor() as executor:
+            list(executor.map(convert_to_XML, pairs))
 
 if __name__ == '__main__':
     command_line_runner()